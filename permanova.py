@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
 # Copyright (C) 2010 - 2012, University of New Orleans
@@ -10,22 +10,153 @@
 #
 # Author: Johnny Brown
 
+import contextlib
+import multiprocessing
+
 import numpy as np
-import random as r
-from itertools import permutations, product, chain
+from scipy.spatial.distance import squareform
+
+#numba is optional; without it the permutations run through numpy
+try:
+    from numba import njit, prange
+    has_numba = True
+except ImportError:
+    has_numba = False
+
+#permuted F-ratios within this relative distance of the observed one are
+#treated as ties, so differences in summation order can't decide whether a
+#relabelling of the observed groups counts as above it
+_TIE_RTOL = 1e-5
 
-from scipy import stats
-#stats.ss chokes on generators. Might be worth fixing that.
-stats.ss = lambda l: sum(a*a for a in l)
+#the NumPy path scores permutations in blocks, sized so a block's
+#permutations x n(n-1)/2 matrix of group masks has at most this many elements
+_BLOCK_ELEMS = 2**22
+
+#the numba kernels are only used once n(n-1)/2 x permutations reaches this
+#many pair visits. Below it, loading or compiling them costs more than the
+#NumPy path takes to run every permutation
+_NUMBA_MIN_WORK = 5*10**7
 
 def above_diagonal(n):
-    row = xrange(n)
+    row = range(n)
     for i in row:
-        for j in xrange(i+1,n):
+        for j in range(i+1,n):
             yield i,j
-    
 
-def permanova_oneway(dm, levels, permutations = 200):
+def _encode(levels):
+    """Integer codes for levels, and the number of distinct levels. Levels
+    are compared like set() does, so any hashable labels work, including
+    tuples and mixed types."""
+    index = {}
+    codes = np.fromiter((index.setdefault(l, len(index)) for l in levels),
+                        np.int32, len(levels))
+    return codes, len(index)
+
+def _tie_bound(f, sign):
+    """f moved by _TIE_RTOL of its magnitude, up for sign 1 and down for sign
+    -1. Infinite F-ratios are left alone."""
+    if not np.isfinite(f):
+        return f
+    return f + sign*abs(f)*_TIE_RTOL
+
+def _condensed_sq(dm, bign):
+    """Squared distances of the top half of dm, row by row, as a flat vector.
+    dm may be a square distance matrix or already condensed, as returned by
+    scipy.spatial.distance.pdist."""
+    dm = np.asarray(dm, dtype=np.float64)#distance matrix
+    if dm.ndim == 2:
+        assert dm.shape == (bign,bign) #check the dist matrix is square and
+                                       #the size corresponds to the levels
+        dm = squareform(dm, checks=False)
+
+    assert dm.shape == (bign*(bign-1)//2,)
+
+    return np.square(dm)
+
+def _use_numba(d2, permutations):
+    """Whether the permutations over d2 should run in the numba kernels."""
+    return has_numba and len(d2)*permutations >= _NUMBA_MIN_WORK
+
+def _triangle_rows(d2, bign):
+    """(i, squared distances from i to i+1, ..., bign-1) for each row of the
+    flat top half of dm."""
+    start = 0
+    for i in range(bign-1):
+        end = start + bign-i-1
+        yield i, d2[start:end]
+        start = end
+
+def _check_n_jobs(n_jobs):
+    """The number of processes n_jobs asks for, with -1 meaning every CPU."""
+    if n_jobs == -1:
+        return multiprocessing.cpu_count()
+    if n_jobs < 1:
+        raise ValueError("n_jobs must be -1 or a positive integer, got %r"
+                         % (n_jobs,))
+    return n_jobs
+
+def _job_rngs(seed, n_jobs, streams):
+    """A list of streams independent generators for each of n_jobs jobs, all
+    spawned from seed."""
+    return [[np.random.default_rng(s) for s in job.spawn(streams)]
+            for job in np.random.SeedSequence(seed).spawn(n_jobs)]
+
+def _pool(n_jobs):
+    """A pool of n_jobs processes, or a context giving None for one job."""
+    if n_jobs == 1:
+        return contextlib.nullcontext()
+
+    #numba's threads may already be running in this process, from a larger
+    #problem, and forking them can deadlock, so start fresh interpreters
+    context = multiprocessing.get_context("spawn" if has_numba else None)
+    return context.Pool(n_jobs)
+
+def _run_batches(pool, batch, args, rngs, start, stop):
+    """Runs permutations start to stop-1 split across the jobs in rngs, as
+    batch(*args, size, job_rngs) in pool, and returns each job's result.
+    Permutation i is run by job i % len(rngs), and every batch hands back its
+    advanced generators, so a run split over several calls draws the same
+    permutations as a single call."""
+    n_jobs = len(rngs)
+    sizes = [len(range(k, stop, n_jobs)) - len(range(k, start, n_jobs))
+             for k in range(n_jobs)]
+    jobs = [args + (size, r) for size, r in zip(sizes, rngs)]
+
+    if pool is None:
+        results = [batch(*jobs[0])]
+    else:
+        results = pool.starmap(batch, jobs)
+
+    rngs[:] = [r for _, r in results]
+    return [c for c, _ in results]
+
+def _run_permutations(count, permutations, early_stop, alpha):
+    """Returns the total of count(start, stop), the counts for permutations
+    start to stop-1, over all the permutations, and the number of permutations
+    actually run. With early_stop they are run in chunks, stopping as soon as
+    every count is above alpha*permutations, since the p-values can then only
+    end up above alpha. count draws every permutation from one stream, so a
+    run that doesn't stop gives the same counts as early_stop=False."""
+    if not early_stop:
+        return np.asarray(count(0, permutations)), permutations
+
+    chunks = min(permutations, 10)
+    sizes = [permutations//chunks + (k < permutations % chunks)
+             for k in range(chunks)]
+
+    above = 0
+    done = 0
+    for size in sizes:
+        above = above + np.asarray(count(done, done + size))
+        done += size
+
+        if np.all(above > alpha*permutations):
+            break
+
+    return above, done
+
+def permanova_oneway(dm, levels, permutations = 200, seed = None, n_jobs = 1,
+                     early_stop = False, alpha = 0.05):
     """ 
     Performs one-way permutational ANOVA on the given distance matrix.
 
@@ -45,7 +176,8 @@ def permanova_oneway(dm, levels, permutations = 200):
     ----------
     dm : array_like
         The distance matrix of observations x observations. Represents a 
-        symmetric n x n matrix with zeros on the diagonal.
+        symmetric n x n matrix with zeros on the diagonal. May also be given 
+        in condensed form, as returned by scipy.spatial.distance.pdist.
 
     levels : array_like
         An array indicating the levels of the variable at each observation, such
@@ -57,6 +189,31 @@ def permanova_oneway(dm, levels, permutations = 200):
         If there are less than ``permutations`` unique permutations, then all of 
         them will be used
 
+    seed : int, optional
+        Seed for the random number generator used to permute the levels, for
+        reproducible p-values. Each backend draws its permutations from the 
+        seed differently, so a seed only reproduces a p-value with the same 
+        number of processes (``n_jobs``, with -1 depending on the machine) 
+        and the same backend, i.e. numba installed or not (see ``n_jobs``).
+
+    n_jobs : int
+        The number of processes the permutations are split across, or -1 to 
+        use every CPU. Any other value raises ValueError. Default is 1. 
+        Ignored when numba is installed and n(n-1)/2 x ``permutations`` is 
+        large enough to use it, since the permutations then already run on 
+        every core. Otherwise, with numba installed the processes are 
+        spawned, so the calling script needs an 
+        ``if __name__ == "__main__":`` guard.
+
+    early_stop : bool
+        If True, stop permuting as soon as the p-value is certain to be above 
+        ``alpha``. The p-value returned is then estimated from the 
+        permutations run so far, and is only meaningful compared to 
+        ``alpha``. Default is False.
+
+    alpha : float
+        The significance level used by ``early_stop``. Default is 0.05.
+
     Returns
     -------
     F-value : float
@@ -87,27 +244,53 @@ def permanova_oneway(dm, levels, permutations = 200):
     .. [3] Jones, James. Lecture notes for Concepts of Statistics
            http://people.richland.edu/james/lecture/m170/ch13-2wy.html
     """
-    bigf = f_oneway(dm,levels)
-
-    above = below = 0
-    nf = 0
-
-    #TODO make this pretty with math and functions
-    #perms = r.sample(list(perm_unique(levels)),permutations)
-    shuffledlevels = list(levels)#copy list so we can shuffle it
-    
-    for i in xrange(permutations):
-        r.shuffle(shuffledlevels)
-        f = f_oneway(dm,shuffledlevels)
-        
-        if f >= bigf:
-            above += 1
-
-        #debug
-        ## print shuffledlevels
-        ## print f
-
-    p = above/float(permutations)
+    bign = len(levels)#number of observations
+    n_jobs = _check_n_jobs(n_jobs)
+
+    #dm and the total sum of squares don't change between permutations, only
+    #the assignment of levels does. Only the top half of dm is needed, so keep
+    #it as a flat vector of squared distances
+    d2 = _condensed_sq(dm, bign)
+    sst = d2.sum()/float(bign)
+
+    #integer codes for the levels, so shuffling doesn't touch python objects
+    levels_arr, a = _encode(levels)#a is the number of levels
+    n = bign//a#number of observations per level
+
+    bigf = _f_oneway_d2(d2, sst, levels_arr, a, n, bign)
+    bigf_lo = _tie_bound(bigf, -1)
+
+    use_numba = _use_numba(d2, permutations)
+    if use_numba:
+        #the numba kernel reads float32 squared distances, halving the bytes
+        #per permutation, but sums them in float64. Its permutations are
+        #compared against the F-ratio of the same rounded distances
+        d2 = d2.astype(np.float32)
+        sst = d2.sum(dtype=np.float64)/float(bign)
+        bigf_lo = _tie_bound(_f_oneway_d2(d2, sst, levels_arr, a, n, bign), -1)
+
+        #one seed per permutation, so the result doesn't depend on which
+        #thread runs which permutation. They're all drawn up front, and
+        #early_stop's chunks take slices of them
+        seeds = np.random.default_rng(seed).integers(2**31, size=permutations)
+        n_jobs = 1
+    else:
+        rngs = _job_rngs(seed, n_jobs, 1)
+
+    with _pool(n_jobs) as pool:
+        def count(start, stop):
+            if use_numba:
+                return _permanova_counts(d2, sst, levels_arr, a, n, bign,
+                                         seeds[start:stop], bigf_lo)
+
+            return sum(_run_batches(pool, _oneway_batch,
+                                    (d2, sst, levels_arr, a, n, bign, bigf_lo),
+                                    rngs, start, stop))
+
+        above, done = _run_permutations(count, permutations, early_stop,
+                                        alpha)
+
+    p = int(above)/float(done)
 
     return (bigf,p)
 
@@ -116,22 +299,28 @@ def permanova_oneway(dm, levels, permutations = 200):
 #desired sum of squares
 def f_oneway(dm,levels):
     bign = len(levels)#number of observations
-    dm = np.asarray(dm)#distance matrix
-    a = len(set(levels))#number of levels
-    n = bign/a#number of observations per level
-    
-    assert dm.shape == (bign,bign) #check the dist matrix is square and the size
-                                   #corresponds to the length of levels
+    levels_arr, a = _encode(levels)#a is the number of levels
+    n = bign//a#number of observations per level
+
+    #squared distances in the top half of dm, as a flat vector
+    d2 = _condensed_sq(dm, bign)
+
+    #total sum of squared distances
+    sst = d2.sum()/float(bign)
 
-    #total sum of squared distances                                   
-    sst = np.sum(stats.ss(r) for r in 
-              (s[n+1:] for n,s in enumerate(dm[:-1])) )/float(bign)
+    return _f_oneway_d2(d2, sst, levels_arr, a, n, bign)
 
-    #sum of within-group squares
-    #itertools.combinations(xrange(len(dm)),2)#top half of dm
-    ssw = np.sum((dm[i][j]**2 for i,j in  
-               product(xrange(len(dm)),xrange(1,len(dm)))
-               if i<j and levels[i] == levels[j]))/float(n)
+def _f_from_sq(d2, sst, levels_arr, iu, a, n, bign):
+    """F-ratio for the integer-coded levels_arr given the squared distances
+    d2 = dm[iu]**2 of the top half of dm and the total sum of squares, which
+    are the same for every permutation of the levels. levels_arr may also be a
+    permutations x bign array, giving one F-ratio per row."""
+    iu_i, iu_j = iu
+
+    #sum of within-group squares. A product with the 0/1 mask avoids
+    #gathering the selected elements of d2 into a temporary first
+    same = levels_arr[...,iu_i] == levels_arr[...,iu_j]
+    ssw = (same.astype(d2.dtype) @ d2)/float(n)
 
     ssa = sst - ssw
 
@@ -140,7 +329,82 @@ def f_oneway(dm,levels):
 
     return fstat
 
-def permanova_twoway(dm,levels,permutations=200):
+def _f_oneway_d2(d2, sst, levels_arr, a, n, bign):
+    """F-ratio for a single levels_arr from the flat squared distances d2,
+    summed a row at a time in float64, so neither the pair indices nor a numba
+    kernel are needed."""
+    ssw = sum(row[levels_arr[i+1:] == levels_arr[i]].sum(dtype=np.float64)
+              for i, row in _triangle_rows(d2, bign))/float(n)
+
+    return ((sst - ssw)/float(a-1))/(ssw/float(bign-a))
+
+def _oneway_batch(d2, sst, levels_arr, a, n, bign, bigf, permutations, rngs):
+    """Number of permutations of levels_arr with an F-ratio >= bigf, drawn
+    from the generator in rngs, and rngs."""
+    rng, = rngs
+    iu = np.triu_indices(bign, 1)
+    block = max(1, _BLOCK_ELEMS//len(d2))
+    above = 0
+
+    for start in range(0, permutations, block):
+        #one shuffled copy of the levels per row
+        size = min(block, permutations - start)
+        shuffledlevels = rng.permuted(np.broadcast_to(levels_arr, (size, bign)),
+                                      axis=1)
+        f = _f_from_sq(d2, sst, shuffledlevels, iu, a, n, bign)
+
+        above += int((f >= bigf).sum())
+
+    return above, rngs
+
+if has_numba:
+    @njit(cache=True)
+    def _shuffle(arr):
+        """In-place Fisher-Yates shuffle using numba's per-thread generator."""
+        for k in range(len(arr)-1, 0, -1):
+            j = np.random.randint(0, k+1)
+            tmp = arr[k]
+            arr[k] = arr[j]
+            arr[j] = tmp
+
+    @njit(fastmath={'reassoc', 'contract'}, error_model='numpy',
+          cache=True)
+    def _f_oneway_scan(d2, sst, levels_arr, a, n, bign):
+        """_f_from_sq as a single pass over d2."""
+        #sum of within-group squares. d2 holds the top half of dm row by
+        #row, so pair (i,j) is just the next element
+        ssw = 0.0
+        k = 0
+        for i in range(bign):
+            for j in range(i+1, bign):
+                if levels_arr[i] == levels_arr[j]:
+                    ssw += d2[k]
+                k += 1
+        ssw /= n
+
+        return ((sst - ssw)/(a-1))/(ssw/(bign-a))
+
+    @njit(parallel=True, fastmath={'reassoc', 'contract'},
+          error_model='numpy', cache=True)
+    def _permanova_counts(d2, sst, levels_arr, a, n, bign, seeds, bigf):
+        """Number of permutations of levels_arr with an F-ratio >= bigf. Runs
+        one permutation per seed, in parallel."""
+        counts = 0
+        for p in prange(len(seeds)):
+            np.random.seed(seeds[p])
+
+            #shuffle a private copy of the levels
+            shuffled = levels_arr.copy()
+            _shuffle(shuffled)
+
+            f = _f_oneway_scan(d2, sst, shuffled, a, n, bign)
+            if f >= bigf:
+                counts += 1
+
+        return counts
+
+def permanova_twoway(dm,levels,permutations=200,seed=None,n_jobs=1,
+                     early_stop=False,alpha=0.05):
     """Performs one-way permutational ANOVA on the given distance matrix.
 
     One-way permanova tests the null hypothesis that distances between levels of
@@ -159,7 +423,8 @@ def permanova_twoway(dm,levels,permutations=200):
     ----------
     dm : array_like
         The distance matrix of observations x observations. Represents a 
-        symmetric n x n matrix with zeros on the diagonal.
+        symmetric n x n matrix with zeros on the diagonal. May also be given 
+        in condensed form, as returned by scipy.spatial.distance.pdist.
 
     levels : array_like
         An array of pairs indicating the levels of the variable at each 
@@ -171,6 +436,31 @@ def permanova_twoway(dm,levels,permutations=200):
         If there are less than ``permutations`` unique permutations, then all of 
         them will be used
 
+    seed : int, optional
+        Seed for the random number generator used to permute the levels, for
+        reproducible p-values. Each backend draws its permutations from the 
+        seed differently, so a seed only reproduces a p-value with the same 
+        number of processes (``n_jobs``, with -1 depending on the machine) 
+        and the same backend, i.e. numba installed or not (see ``n_jobs``).
+
+    n_jobs : int
+        The number of processes the permutations are split across, or -1 to 
+        use every CPU. Any other value raises ValueError. Default is 1. 
+        Ignored when numba is installed and n(n-1)/2 x ``permutations`` is 
+        large enough to use it, since the permutations then already run on 
+        every core. Otherwise, with numba installed the processes are 
+        spawned, so the calling script needs an 
+        ``if __name__ == "__main__":`` guard.
+
+    early_stop : bool
+        If True, stop permuting as soon as the p-value is certain to be above 
+        ``alpha``. The p-value returned is then estimated from the 
+        permutations run so far, and is only meaningful compared to 
+        ``alpha``. Default is False.
+
+    alpha : float
+        The significance level used by ``early_stop``. Default is 0.05.
+
     Returns
     -------
     F-values : 3-tuple
@@ -207,81 +497,228 @@ def permanova_twoway(dm,levels,permutations=200):
            http://people.richland.edu/james/lecture/m170/ch13-2wy.html
     """
 
-    bigf_i, bigf_a, bigf_b = f_twoway(dm,levels)
+    bign = len(levels)#number of observations
+    n_jobs = _check_n_jobs(n_jobs)
 
-    above_i = above_a = above_b = 0
+    a_levels, a = _encode([l[0] for l in levels])#a is the number of a-levels
+    b_levels, b = _encode([l[1] for l in levels])#b is the number of b-levels
+    n = bign/float(a*b)#number of observations per level
 
-    #TODO make this pretty with math and functions
-    #perms = r.sample(list(perm_unique(levels)),permutations)
-    shuffledlevels = list(levels)#copy list so we can shuffle it
+    #the squared distances in the top half of dm, and their total, don't
+    #change between permutations
+    d2 = _condensed_sq(dm, bign)
+    sst = d2.sum()/float(bign)
+
+    bigf = _f_twoway_d2(d2, sst, a_levels, b_levels, a, b, n, bign)
+    bigf_hi = tuple(_tie_bound(f, 1) for f in bigf)
+
+    use_numba = _use_numba(d2, permutations)
+    if use_numba:
+        #float32 storage with float64 sums, as in permanova_oneway
+        d2 = d2.astype(np.float32)
+        sst = d2.sum(dtype=np.float64)/float(bign)
+        bigf_hi = tuple(_tie_bound(f, 1) for f in
+                        _f_twoway_d2(d2, sst, a_levels, b_levels,
+                                     a, b, n, bign))
+
+        #one seed per permutation, as in permanova_oneway
+        seeds = np.random.default_rng(seed).integers(2**31, size=permutations)
+        n_jobs = 1
+    else:
+        #one generator per kind of permutation, so each is drawn in order
+        #however the permutations are split up
+        rngs = _job_rngs(seed, n_jobs, 3)
+
+    with _pool(n_jobs) as pool:
+        def count(start, stop):
+            if use_numba:
+                return _permanova_twoway_counts(d2, sst, a_levels, b_levels,
+                                                a, b, n, bign,
+                                                seeds[start:stop], bigf_hi)
+
+            counts = _run_batches(pool, _twoway_batch,
+                                  (d2, sst, a_levels, b_levels, a, b, n, bign,
+                                   bigf_hi),
+                                  rngs, start, stop)
+            return [sum(c) for c in zip(*counts)]
+
+        above, done = _run_permutations(count, permutations, early_stop,
+                                        alpha)
+
+    p_i,p_a,p_b = [ int(above_x)/float(done) for above_x in above]
+
+    return (tuple(bigf), (p_i, p_a, p_b))
 
-    a_levels = list([l[0] for l in levels])
-    b_levels = list([l[1] for l in levels])
     
-    #permutations
-    for i in xrange(permutations):
-        #All these are probably the wrong way to do the permutations. Wrong as in
-        #incorrect
-        ## r.shuffle(a_levels)
-        ## r.shuffle(b_levels)
-        ## shuffledlevels = zip(a_levels,b_levels)
-
-        r.shuffle(shuffledlevels)
-        
-        f_i, f_a, f_b = f_twoway(dm,shuffledlevels)
-
-        if f_i > bigf_i:
-            above_i += 1
-
-    for i in xrange(permutations):
-        r.shuffle(a_levels)
-
-        f_i, f_a, f_b = f_twoway(dm,zip(a_levels, [l[1] for l in levels]))
+    
+def f_twoway(dm, levels):
+    
+    bign = len(levels)#number of observations
+    a_levels, a = _encode([l[0] for l in levels])#a is the number of a-levels
+    b_levels, b = _encode([l[1] for l in levels])#b is the number of b-levels
+    n = bign/float(a*b)#number of observations per level
 
-        if f_a > bigf_a:
-            above_a += 1
+    #squared distances in the top half of dm, as a flat vector
+    d2 = _condensed_sq(dm, bign)
 
-    for i in xrange(permutations):
-        r.shuffle(b_levels)
+    #sum of all distances
+    sst = d2.sum()/float(bign)
+
+    return _f_twoway_d2(d2, sst, a_levels, b_levels, a, b, n, bign)
+
+def _f_twoway_d2(d2, sst, a_levels, b_levels, a, b, n, bign):
+    """F-ratios (interaction, a, b) for a single a_levels and b_levels from
+    the flat squared distances d2, summed a row at a time as in
+    _f_oneway_d2."""
+    ssr = sswa = sswb = 0.0
+    for i, row in _triangle_rows(d2, bign):
+        same_a = a_levels[i+1:] == a_levels[i]
+        same_b = b_levels[i+1:] == b_levels[i]
+        ssr += row[same_a & same_b].sum(dtype=np.float64)
+        sswa += row[same_a].sum(dtype=np.float64)
+        sswb += row[same_b].sum(dtype=np.float64)
+    ssr /= float(n)
+    sswa /= float(b*n)
+    sswb /= float(a*n)
 
-        f_i, f_a, f_b = f_twoway(dm,zip([l[0] for l in levels], b_levels))
-            
-        if f_b > bigf_b:
-            above_b += 1
+    ssa = sst - sswa#effect of a
+    ssb = sst - sswb#effect of b
+    ssab = sst - ssa - ssb - ssr #interaction sum-of-squares
 
+    f_interaction = (ssab/float((a-1)*(b-1)))/(ssr/float(bign - a*b))
+    f_a = (ssa/float((a-1)))/(ssr/float(bign - a*b))
+    f_b = (ssb/float((b-1)))/(ssr/float(bign - a*b))
 
+    return (f_interaction,f_a,f_b)
 
-    p_i,p_a,p_b = [ above/float(permutations) for above in 
-                    [above_i, above_a, above_b]]
+def _twoway_batch(d2, sst, a_levels, b_levels, a, b, n, bign, bigf,
+                  permutations, rngs):
+    """Numbers of permutations with an F-ratio > bigf for the interaction, a
+    and b tests, in that order, each drawn from its own generator in rngs, and
+    rngs."""
+    rng_i, rng_a, rng_b = rngs
+    iu = np.triu_indices(bign, 1)
+    bigf_i, bigf_a, bigf_b = bigf
+    block = max(1, _BLOCK_ELEMS//len(d2))
 
-    return ((bigf_i, bigf_a, bigf_b), (p_i, p_a, p_b))
+    def f_twoway_perm(a_perm, b_perm):
+        return _f_twoway_from_sq(d2, sst, a_perm, b_perm, iu, a, b, n, bign)
 
-    
-    
-def f_twoway(dm, levels):
-    
-    bign = len(levels)#number of observations
-    dm = np.asarray(dm)#distance matrix
-    l = len(set(levels))#number of levels
-    a = len(set([l[0] for l in levels]))#number of a-levels
-    b = len(set([l[1] for l in levels]))#number of b-levels
-    n = bign/float(a*b)#number of observations per level
+    def shuffled(rng, levels_arr, size):
+        #one shuffled copy of levels_arr per row
+        return rng.permuted(np.broadcast_to(levels_arr, (size, bign)), axis=1)
 
-    #sum of all distances
-    ## sst = np.sum(stats.ss(r) for r in 
-    ##         (s[n+1:] for n,s in enumerate(dm[:-1])) )/float(bign)
-    sst = stats.ss(chain(*(r[i+1:] for i,r in enumerate(dm))))/float(bign)
+    above_i = above_a = above_b = 0
 
-    #same level of both a and b (error, within-group)
-    ssr = select_ss(dm, levels, lambda a,b: a==b)/float(n)
+    for start in range(0, permutations, block):
+        size = min(block, permutations - start)
+
+        #shuffle whole observations, keeping each (a,b) pair together
+        idx = shuffled(rng_i, np.arange(bign), size)
+
+        f_i, f_a, f_b = f_twoway_perm(a_levels[idx], b_levels[idx])
+        above_i += int((f_i > bigf_i).sum())
+
+        f_i, f_a, f_b = f_twoway_perm(shuffled(rng_a, a_levels, size),
+                                      b_levels)
+        above_a += int((f_a > bigf_a).sum())
+
+        f_i, f_a, f_b = f_twoway_perm(a_levels,
+                                      shuffled(rng_b, b_levels, size))
+        above_b += int((f_b > bigf_b).sum())
+
+    return (above_i, above_a, above_b), rngs
+
+if has_numba:
+    @njit(fastmath={'reassoc', 'contract'}, error_model='numpy',
+          cache=True)
+    def _f_twoway_scan(d2, sst, a_levels, b_levels, a, b, n, bign):
+        """_f_twoway_from_sq as a single pass over d2."""
+        ssr = sswa = sswb = 0.0
+        k = 0
+        for i in range(bign):
+            for j in range(i+1, bign):
+                same_a = a_levels[i] == a_levels[j]
+                same_b = b_levels[i] == b_levels[j]
+                if same_a:
+                    sswa += d2[k]
+                    if same_b:
+                        ssr += d2[k]
+                if same_b:
+                    sswb += d2[k]
+                k += 1
+        ssr /= n
+        sswa /= b*n
+        sswb /= a*n
+
+        ssa = sst - sswa
+        ssb = sst - sswb
+        ssab = sst - ssa - ssb - ssr
+
+        f_interaction = (ssab/((a-1)*(b-1)))/(ssr/(bign - a*b))
+        f_a = (ssa/(a-1))/(ssr/(bign - a*b))
+        f_b = (ssb/(b-1))/(ssr/(bign - a*b))
+
+        return (f_interaction, f_a, f_b)
+
+    @njit(parallel=True, fastmath={'reassoc', 'contract'},
+          error_model='numpy', cache=True)
+    def _permanova_twoway_counts(d2, sst, a_levels, b_levels, a, b, n, bign,
+                                 seeds, bigf):
+        """_twoway_batch with one permutation of each kind per seed, run in
+        parallel."""
+        bigf_i, bigf_a, bigf_b = bigf
+        above_i = above_a = above_b = 0
+        for p in prange(len(seeds)):
+            np.random.seed(seeds[p])
+
+            #shuffle whole observations, keeping each (a,b) pair together
+            idx = np.arange(bign)
+            _shuffle(idx)
+            f_i = _f_twoway_scan(d2, sst, a_levels[idx], b_levels[idx],
+                                 a, b, n, bign)[0]
+            if f_i > bigf_i:
+                above_i += 1
+
+            shuffled_a = a_levels.copy()
+            _shuffle(shuffled_a)
+            f_a = _f_twoway_scan(d2, sst, shuffled_a, b_levels,
+                                 a, b, n, bign)[1]
+            if f_a > bigf_a:
+                above_a += 1
+
+            shuffled_b = b_levels.copy()
+            _shuffle(shuffled_b)
+            f_b = _f_twoway_scan(d2, sst, a_levels, shuffled_b,
+                                 a, b, n, bign)[2]
+            if f_b > bigf_b:
+                above_b += 1
+
+        return (above_i, above_a, above_b)
+
+def _f_twoway_from_sq(d2, sst, a_levels, b_levels, iu, a, b, n, bign):
+    """F-ratios (interaction, a, b) for the integer-coded a_levels and b_levels
+    given the squared distances d2 = dm[iu]**2 of the top half of dm and the
+    total sum of squares. All three sums reuse the same d2. Either set of
+    levels may also be a permutations x bign array, giving one F-ratio of each
+    kind per row."""
+    iu_i, iu_j = iu
+
+    #0/1 masks, so each sum is a product with d2
+    a_eq = (a_levels[...,iu_i] == a_levels[...,iu_j]).astype(d2.dtype)
+    b_eq = (b_levels[...,iu_i] == b_levels[...,iu_j]).astype(d2.dtype)
+
+    #same level of both a and b (error, within-group). Multiplying the two
+    #masks is cheaper than comparing a*b + b_levels cell codes, which would
+    #need another pair of gathers over the triangle
+    ssr = ((a_eq*b_eq) @ d2)/float(n)
 
     #same level of a
-    sswa = select_ss(dm, levels, lambda a,b: a[0] == b[0])/float(b*n)
+    sswa = (a_eq @ d2)/float(b*n)
 
     #same level of b
-    sswb = select_ss(dm, levels, lambda a,b: a[1] == b[1])/float(a*n)
+    sswb = (b_eq @ d2)/float(a*n)
 
-    
     ssa = sst - sswa#effect of a
     ssb = sst - sswb#effect of b
     ssab = sst - ssa - ssb - ssr #interaction sum-of-squares
@@ -296,10 +733,14 @@ def f_twoway(dm, levels):
 def select_ss(dm, levels,  included):
     
     bign = len(dm)
+    I, J = np.triu_indices(bign, 1)
 
-    distances = (dm[i][j] for i,j in above_diagonal(bign) 
-                           if included(levels[i], levels[j]))
+    #included is an arbitrary python predicate, so it is still called per pair,
+    #but the distances are gathered from dm in one go
+    mask = np.fromiter((included(levels[i], levels[j]) for i,j in zip(I, J)),
+                       dtype=bool, count=len(I))
+    distances = np.asarray(dm)[I, J][mask]
 
-    return stats.ss(distances)
+    return np.dot(distances, distances)
 
 
@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
 # Copyright (C) 2010 - 2012, University of New Orleans
@@ -11,7 +11,7 @@
 
 import sys,os
 import numpy as np
-import cPickle as cp
+import pickle as cp
 
 sys.path.append("../")
 sys.path.append(".")
@@ -19,26 +19,131 @@ import permanova
 
 TD = "./test_data"
 
-mapping = open(os.path.join(TD,"cross_TV_BV_map.txt")).readlines()
-headers = mapping[0].strip().split("\t")
-tvi = headers.index("TVstatus")
-tv_levels = [r.strip().split('\t')[tvi] for r in mapping[1:]]
-
-#FOOLISH ASSUMPTION: Mapping file has same ordering as dm file. True here
-#Output from QIIME is used, these results can be compared to similar analyses
-#in QIIME
-dmf = open(os.path.join(TD,"unweighted_unifrac_otu_table.txt")).readlines()
-dm = np.asarray([map(float,r.strip().split("\t")[1:]) for r in dmf[1:]])
-
-#expected: (4.6822758256772135, p), where p is not significant (likely 0 for 
-#any reasonable number of permutations)
-print permanova.permanova_oneway(dm,tv_levels)
-
-#example problem taken from
-#http://people.richland.edu/james/lecture/m170/ch13-2wy.html
-jones_levels = cp.load(open(os.path.join(TD,"jones_levels.cpk")))
-jones_dm = cp.load(open(os.path.join(TD,"jones_dm.cpk")))
-
-#see http://people.richland.edu/james/lecture/m170/ch13-2wy.html for 
-#expected results. Permutations=10000 should approach accuracy
-print permanova.permanova_twoway(jones_dm, jones_levels)
+#the tests only run when this is the main script, not when the process pool
+#spawns workers that import it
+if __name__ == "__main__":
+    mapping = open(os.path.join(TD,"cross_TV_BV_map.txt")).readlines()
+    headers = mapping[0].strip().split("\t")
+    tvi = headers.index("TVstatus")
+    tv_levels = [r.strip().split('\t')[tvi] for r in mapping[1:]]
+
+    #FOOLISH ASSUMPTION: Mapping file has same ordering as dm file. True here
+    #Output from QIIME is used, these results can be compared to similar analyses
+    #in QIIME
+    dmf = open(os.path.join(TD,"unweighted_unifrac_otu_table.txt")).readlines()
+    dm = np.asarray([list(map(float,r.strip().split("\t")[1:])) for r in dmf[1:]])
+
+    #expected: (4.6822758256772135, p), where p is not significant (likely 0 for 
+    #any reasonable number of permutations)
+    print(permanova.permanova_oneway(dm,tv_levels))
+
+    #example problem taken from
+    #http://people.richland.edu/james/lecture/m170/ch13-2wy.html
+    jones_levels = cp.load(open(os.path.join(TD,"jones_levels.cpk"),"rb"))
+    jones_dm = cp.load(open(os.path.join(TD,"jones_dm.cpk"),"rb"))
+
+    #see http://people.richland.edu/james/lecture/m170/ch13-2wy.html for 
+    #expected results. Permutations=10000 should approach accuracy
+    print(permanova.permanova_twoway(jones_dm, jones_levels))
+
+    #the same seed gives the same p-values
+    assert (permanova.permanova_oneway(dm, tv_levels, 100, seed=1) ==
+            permanova.permanova_oneway(dm, tv_levels, 100, seed=1))
+    assert (permanova.permanova_twoway(jones_dm, jones_levels, 100, seed=1) ==
+            permanova.permanova_twoway(jones_dm, jones_levels, 100, seed=1))
+
+    #condensed and square distance matrices give identical results
+    from scipy.spatial.distance import squareform
+    jones_condensed = squareform(np.asarray(jones_dm, dtype=float))
+    assert (permanova.permanova_oneway(squareform(dm, checks=False), tv_levels,
+                                       100, seed=1) ==
+            permanova.permanova_oneway(dm, tv_levels, 100, seed=1))
+    assert (permanova.permanova_twoway(jones_condensed, jones_levels, 100, seed=1) ==
+            permanova.permanova_twoway(jones_dm, jones_levels, 100, seed=1))
+
+    #labels unrelated to the distances, so the test isn't significant
+    rand_levels = list(np.random.default_rng(0).permutation(tv_levels))
+
+    #the numba and NumPy paths agree on F, and on p up to permutation noise
+    if permanova.has_numba:
+        #these are small enough to stay on the NumPy path unless forced
+        min_work = permanova._NUMBA_MIN_WORK
+        permanova._NUMBA_MIN_WORK = 0
+        numba_results = [
+            permanova.permanova_oneway(dm, rand_levels, 2000, seed=1),
+            permanova.permanova_twoway(jones_dm, jones_levels, 2000, seed=1)]
+        permanova._NUMBA_MIN_WORK = min_work
+        numpy_results = [
+            permanova.permanova_oneway(dm, rand_levels, 2000, seed=1),
+            permanova.permanova_twoway(jones_dm, jones_levels, 2000, seed=1)]
+
+        for (f_numba, p_numba), (f_numpy, p_numpy) in zip(numba_results,
+                                                          numpy_results):
+            assert np.allclose(f_numba, f_numpy)
+            assert np.allclose(p_numba, p_numpy, atol=0.05)
+    else:
+        print("numba isn't installed, skipping the numba/NumPy comparison")
+
+    #early_stop only stops once the p-value is certain to be above alpha. With
+    #every permutation above the observed F it stops after the first chunk
+    above, done = permanova._run_permutations(lambda start, stop: stop - start,
+                                              200, True, 0.05)
+    assert done < 200 and above/float(done) > 0.05
+
+    #and on non-significant labels it still reports p > alpha
+    for seed in range(5):
+        f, p = permanova.permanova_oneway(dm, rand_levels, 200, seed=seed,
+                                          early_stop=True)
+        assert p > 0.05
+
+    #shuffling the labels of 29 observations leaves the test significant, but
+    #with some permutations above the observed F. early_stop then never
+    #stops, and must draw the same permutations as a single run, on both
+    #the NumPy and numba paths
+    mixed_levels = np.array(tv_levels)
+    mixed = np.random.default_rng(0).permutation(len(mixed_levels))[:29]
+    mixed_levels[mixed] = np.random.default_rng(1).permutation(
+        mixed_levels[mixed])
+    mixed_levels = list(mixed_levels)
+
+    run_permutations = permanova._run_permutations
+    runs = []
+    def recording_run_permutations(*args):
+        above, done = run_permutations(*args)
+        runs.append(done)
+        return above, done
+    permanova._run_permutations = recording_run_permutations
+
+    min_work = permanova._NUMBA_MIN_WORK
+    for work in ([min_work, 0] if permanova.has_numba else [min_work]):
+        permanova._NUMBA_MIN_WORK = work
+        f, p = permanova.permanova_oneway(dm, mixed_levels, 200, seed=1)
+        f_es, p_es = permanova.permanova_oneway(dm, mixed_levels, 200,
+                                                seed=1, early_stop=True)
+        assert 0 < p <= 0.05
+        assert p_es == p and runs[-1] == 200
+    permanova._NUMBA_MIN_WORK = min_work
+    permanova._run_permutations = run_permutations
+
+    #select_ss sums the squared distances of the pairs the predicate picks
+    for included in (lambda x, y: x == y, lambda x, y: x[0] == y[0],
+                     lambda x, y: x[1] != y[1]):
+        expected = sum(jones_dm[i][j]**2 for i in range(len(jones_dm))
+                       for j in range(i+1, len(jones_dm))
+                       if included(jones_levels[i], jones_levels[j]))
+        assert np.isclose(permanova.select_ss(jones_dm, jones_levels,
+                                              included), expected)
+
+    #n_jobs is -1 or a positive number of processes
+    for n_jobs in (0, -2):
+        try:
+            permanova.permanova_oneway(dm, tv_levels, 10, n_jobs=n_jobs)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("n_jobs=%d was accepted" % n_jobs)
+
+    #with a fixed seed and n_jobs, the NumPy path's process pool is reproducible
+    assert (permanova.permanova_oneway(dm, rand_levels, 200, seed=1, n_jobs=2)
+            == permanova.permanova_oneway(dm, rand_levels, 200, seed=1,
+                                          n_jobs=2))